@@ -0,0 +1,242 @@
+"""
+KudiSMS API Client
+Shared by the church SMS scripts: one pooled HTTP session, rate
+limiting, phone number normalization and response parsing for
+sending SMS via the KudiSMS API.
+"""
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from urllib3.util.retry import Retry
+import random
+import re
+import threading
+import time
+from collections import deque
+
+API_URL = "https://my.kudisms.net/api/sms"
+MAX_RECIPIENTS_PER_REQUEST = 100  # KudiSMS rejects larger batches (error 108)
+REQUESTS_PER_MINUTE = 100  # Provider's request rate ceiling
+LOW_REMAINING_REQUESTS = 2  # Pause once the provider reports this few requests left
+TARGET_LATENCY = 2.0  # Seconds; slower responses stop concurrency from growing
+PHONE_PATTERN = re.compile(r'[0-9]{10,15}')  # ASCII only; \d also matches other scripts' digits
+PHONE_SEPARATORS = str.maketrans('', '', ' \t\r\n-()+')  # Stripped before matching
+SUCCESS_PATTERN = re.compile(rb'(?:000|OK)\b', re.IGNORECASE)  # Plain-text success replies
+
+class RateLimiter:
+    """Sliding-window limit on requests per minute, shared by all sending threads"""
+    
+    def __init__(self, limit, window=60.0):
+        self.limit = limit
+        self.window = window
+        self.sent = deque()  # Send times within the window, including reserved ones
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+    
+    def pause(self, seconds):
+        """Hold back every request for the next `seconds` seconds"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    
+    def acquire(self):
+        """Block until a request may be sent"""
+        with self.lock:
+            now = time.monotonic()
+            while self.sent and now - self.sent[0] >= self.window:
+                self.sent.popleft()
+            
+            # Once the window is full, the next slot opens when the
+            # request `limit` places back falls out of it
+            slot = max(now, self.paused_until)
+            if len(self.sent) >= self.limit:
+                slot = max(slot, self.sent[-self.limit] + self.window)
+            self.sent.append(slot)
+        
+        if slot > now:
+            time.sleep(slot - now)
+
+class AdaptiveConcurrency:
+    """AIMD cap on requests in flight: creeps up while the API responds quickly,
+    halves as soon as it throttles, errors or times out"""
+    
+    def __init__(self, maximum, minimum=1, increase=0.5, decrease=0.5):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.increase = increase
+        self.decrease = decrease
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+    
+    def acquire(self):
+        """Block until fewer than the current limit of requests are in flight"""
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+    
+    def release(self, healthy=None):
+        """Finish a request; True grows the limit, False shrinks it, None leaves it"""
+        with self.condition:
+            self.in_flight -= 1
+            if healthy:
+                self.limit = min(self.maximum, self.limit + self.increase)
+            elif healthy is False:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+            self.condition.notify_all()
+
+def clean_phone(phone):
+    """Convert a phone number to Nigerian international format, or None if invalid"""
+    digits = str(phone).translate(PHONE_SEPARATORS)
+    if not PHONE_PATTERN.fullmatch(digits):
+        return None
+    
+    # Ensure Nigerian format
+    if digits.startswith('0'):
+        return '234' + digits[1:]
+    if not digits.startswith('234'):
+        return '234' + digits
+    return digits
+
+def parse_response(body):
+    """Work out whether a raw KudiSMS API response body reports success"""
+    body = body.strip()
+    # Decoded once, only for reporting; the checks below work on the bytes
+    resp_text = body.decode('utf-8', 'replace')
+    
+    # Only attempt JSON decoding when the body looks like an object
+    if body[:1] == b"{":
+        try:
+            return orjson.loads(body).get("status") == "success", resp_text
+        except ValueError:
+            pass
+    
+    # Otherwise, look for the '000' success code or a leading 'OK'
+    return SUCCESS_PATTERN.match(body) is not None, resp_text
+
+def _connect_failed(error):
+    """Whether a request error happened before anything reached the server"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0] if error.args else None, 'reason', None)
+    return isinstance(reason, NewConnectionError)
+
+class KudiClient:
+    """Send SMS through the KudiSMS API over one pooled session"""
+    
+    def __init__(self, token, sender_id, gateway='2', api_url=API_URL, pool_size=16,
+                 requests_per_minute=REQUESTS_PER_MINUTE, retries=3, retry_base=1.0,
+                 retry_cap=30.0, session=None):
+        self.token = token
+        self.sender_id = sender_id
+        self.gateway = gateway
+        self.api_url = api_url
+        # Parameters shared by every request, built once
+        self.base_params = {
+            "token": token,
+            "senderID": sender_id,
+            "gateway": gateway
+        }
+        self.session = session or self._make_session(pool_size)
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self.concurrency = AdaptiveConcurrency(pool_size)
+        self.retries = retries
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+    
+    @staticmethod
+    def _make_session(pool_size):
+        """Create an HTTP session that reuses pooled connections to the API"""
+        session = requests.Session()
+        # A failed connect means nothing was sent, so urllib3 can safely
+        # retry it straight away (pooled sockets the server has dropped are
+        # already discarded before reuse). Everything else is retried by
+        # send_bulk(), under the rate limiter.
+        retry = Retry(total=None, connect=2, read=False, status=0, other=False)
+        session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                                              pool_block=False, max_retries=retry))
+        return session
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def close(self):
+        """Close pooled connections"""
+        self.session.close()
+    
+    def _respect_rate_limit_headers(self, response):
+        """Pause all senders when the API says its rate limit is (nearly) used up"""
+        retry_after = response.headers.get("Retry-After")
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        if retry_after is None:
+            return
+        
+        try:
+            exhausted = response.status_code == 429 or (
+                remaining is not None and int(remaining) <= LOW_REMAINING_REQUESTS)
+            if exhausted:
+                self.rate_limiter.pause(float(retry_after))
+        except ValueError:
+            # Retry-After given as an HTTP date, or a malformed header
+            pass
+    
+    def _retry_delay(self, attempt, retry_after=None):
+        """Full-jitter exponential backoff, stretched to the server's Retry-After"""
+        delay = random.random() * min(self.retry_cap, self.retry_base * 2 ** attempt)
+        try:
+            return max(delay, float(retry_after)) if retry_after else delay
+        except ValueError:
+            return delay
+    
+    def send_bulk(self, phones, message):
+        """Send one SMS to a list of recipients in a single API call,
+        retrying only failures where the provider cannot have accepted it"""
+        params = {**self.base_params, "recipients": ",".join(phones), "message": message}
+        
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            healthy = None
+            self.concurrency.acquire()
+            try:
+                self.rate_limiter.acquire()
+                started = time.monotonic()
+                response = self.session.get(self.api_url, params=params, timeout=30)
+                self._respect_rate_limit_headers(response)
+                # Raw bytes; response.text would run charset detection on every body
+                success, resp_text = parse_response(response.content)
+                retry_after = response.headers.get("Retry-After")
+                resp_text = resp_text or f"HTTP {response.status_code}"
+                if response.status_code < 500 and response.status_code != 429:
+                    # Only quick 2xx replies grow concurrency; client errors
+                    # such as a bad token say nothing about the API's load
+                    if (200 <= response.status_code < 300 and
+                            time.monotonic() - started <= TARGET_LATENCY):
+                        healthy = True
+                    return success, resp_text
+                
+                healthy = False
+                result = False, resp_text
+                # Other server errors may come after the SMS was accepted, and
+                # sending again would bill every recipient twice
+                if not (response.status_code == 429 or
+                        (response.status_code == 503 and retry_after)):
+                    return result
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # Exception text can include the request URL, and with it the API token
+                healthy = False
+                result = False, type(e).__name__
+                if not _connect_failed(e):
+                    return result
+            except Exception as e:
+                return False, type(e).__name__
+            finally:
+                self.concurrency.release(healthy)
+            
+            if attempt < self.retries:
+                time.sleep(self._retry_delay(attempt, retry_after))
+        
+        return result
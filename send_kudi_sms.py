@@ -5,30 +5,88 @@ This script sends personalized SMS messages to church members
 via KudiSMS API using data from Google Sheets.
 """
 import os
-import requests
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from dotenv import load_dotenv
 from datetime import datetime
+from dataclasses import dataclass
+from functools import lru_cache
+from contextlib import redirect_stdout
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import re
+import sys
 import time
 import json
+from kudi_sms import API_URL, MAX_RECIPIENTS_PER_REQUEST, KudiClient, clean_phone
 
-# Load environment variables
-load_dotenv()
+LOG_WRITE_ATTEMPTS = 3  # Delivery log writes retried on Sheets quota errors
+LOG_FORMATS = ('text', 'jsonl')  # Accepted KUDI_LOG_FORMAT values
+PLACEHOLDER_PATTERN = re.compile(r'\{(name|first_name|gender|address)\}')
 
-# 🔐 API Credentials
-KUDI_API_KEY = os.getenv("KUDI_API_KEY")
-GOOGLE_SHEETS_CREDS = os.getenv("GOOGLE_SHEETS_CREDS")  # JSON credentials as string
-SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
-API_URL = "https://my.kudisms.net/api/sms"
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Credentials and tuning read from the environment"""
+    # 🔐 API Credentials
+    kudi_api_key: str | None
+    google_sheets_creds: str | None  # JSON credentials as string
+    spreadsheet_id: str | None
+    concurrency: int  # SMS requests kept in flight at once
+    requests_per_minute: int  # KudiSMS API rate ceiling
+    batch_size: int  # Recipients per bulk request, at most MAX_RECIPIENTS_PER_REQUEST
+    retries: int  # Extra attempts per failed request
+    retry_base: float  # Backoff seconds, doubled per attempt
+    retry_cap: float  # Longest backoff in seconds
+    log_format: str  # 'text' progress reports, or 'jsonl' for one JSON object per send
 
-def connect_to_sheets():
+def env_number(name, default, cast=int, minimum=0):
+    """Read a numeric setting from the environment, exiting if it is invalid"""
+    raw = os.getenv(name, default)
+    try:
+        value = cast(raw)
+    except ValueError:
+        value = None
+    
+    if value is None or not value >= minimum:
+        print(f"❌ ERROR: {name} must be a number of at least {minimum} (got {raw!r})\n",
+              file=sys.stderr)
+        exit(1)
+    return value
+
+@lru_cache(maxsize=1)
+def load_config():
+    """Read configuration from the environment once per process"""
+    # Load environment variables from .env; values already set in the
+    # environment (e.g. GitHub Actions secrets) take precedence
+    load_dotenv()
+    
+    # Errors go to stderr, as they can come before the output format is known
+    log_format = os.getenv("KUDI_LOG_FORMAT", "text").lower()
+    if log_format not in LOG_FORMATS:
+        print(f"❌ ERROR: KUDI_LOG_FORMAT must be one of {', '.join(LOG_FORMATS)} (got {log_format!r})\n",
+              file=sys.stderr)
+        exit(1)
+    
+    return Config(
+        kudi_api_key=os.getenv("KUDI_API_KEY"),
+        google_sheets_creds=os.getenv("GOOGLE_SHEETS_CREDS"),
+        spreadsheet_id=os.getenv("SPREADSHEET_ID"),
+        concurrency=env_number("KUDI_CONCURRENCY", "16", minimum=1),
+        requests_per_minute=env_number("KUDI_RPM", "100", minimum=1),
+        batch_size=env_number("KUDI_BATCH", str(MAX_RECIPIENTS_PER_REQUEST), minimum=1),
+        retries=env_number("KUDI_RETRIES", "3"),
+        retry_base=env_number("KUDI_RETRY_BASE", "1.0", cast=float),
+        retry_cap=env_number("KUDI_RETRY_CAP", "30.0", cast=float),
+        log_format=log_format,
+    )
+
+def connect_to_sheets(config):
     """Connect to Google Sheets"""
     try:
         print("🔗 Connecting to Google Sheets...")
         
         # Parse credentials from environment variable
-        creds_dict = json.loads(GOOGLE_SHEETS_CREDS)
+        creds_dict = json.loads(config.google_sheets_creds)
         
         scope = [
             'https://spreadsheets.google.com/feeds',
@@ -37,7 +95,7 @@ def connect_to_sheets():
         
         creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
         client = gspread.authorize(creds)
-        sheet = client.open_by_key(SPREADSHEET_ID)
+        sheet = client.open_by_key(config.spreadsheet_id)
         
         print("✅ Connected to Google Sheets successfully!\n")
         return sheet
@@ -74,87 +132,136 @@ def get_settings(sheet):
         }
 
 def get_members(sheet):
-    """Get member data from the Members sheet"""
+    """Get member data from the Members sheet as columns keyed by header"""
     try:
         members_sheet = sheet.worksheet("Members")
-        members_data = members_sheet.get_all_records()
+        values = members_sheet.get_all_values(value_render_option="UNFORMATTED_VALUE")
+        header, rows = (values[0], values[1:]) if values else ([], [])
+        
+        # One list per column instead of one dict per member
+        members_data = {str(key): [str(row[i]) for row in rows] for i, key in enumerate(header)}
         
-        print(f"📋 Found {len(members_data)} members in the database\n")
+        print(f"📋 Found {len(rows)} members in the database\n")
         return members_data
     except Exception as e:
         print(f"❌ Error reading members: {e}")
         exit(1)
 
-def personalize_message(template, member):
+def personalize_message(template, name='', gender='', address=''):
     """Replace placeholders in message template with member data"""
-    message = template
-    
-    # Available placeholders: {name}, {gender}, {address}, {church_name}
+    # Available placeholders: {name}, {first_name}, {gender}, {address}
     replacements = {
-        '{name}': member.get('name', ''),
-        '{first_name}': member.get('name', '').split()[0] if member.get('name') else '',
-        '{gender}': member.get('gender', ''),
-        '{address}': member.get('address', ''),
+        'name': name,
+        'first_name': name.split()[0] if name.strip() else '',
+        'gender': gender,
+        'address': address,
     }
     
-    for placeholder, value in replacements.items():
-        message = message.replace(placeholder, str(value))
-    
-    return message
+    # Single pass over the template; unknown placeholders are left as-is
+    return PLACEHOLDER_PATTERN.sub(lambda match: replacements[match.group(1)], template)
 
-def send_sms(phone, message, sender_id, gateway):
-    """Send SMS to a single recipient"""
-    # Convert phone to string and clean
-    phone = str(phone).strip().lstrip('+')
+def send_batch(client, recipients, message):
+    """Send the same message to a batch of (cleaned phone, [(name, phone), ...]) recipients,
+    returning one result per member"""
+    phones = [cleaned for cleaned, _ in recipients]
+    success, response = client.send_bulk(phones, message)
     
-    # Ensure Nigerian format
-    if phone.startswith('0'):
-        phone = '234' + phone[1:]
-    elif not phone.startswith('234'):
-        phone = '234' + phone
-    
-    params = {
-        "token": KUDI_API_KEY,
-        "senderID": sender_id,
-        "recipients": phone,
-        "message": message,
-        "gateway": gateway
-    }
+    return [{
+        'name': name,
+        'phone': phone,
+        'status': 'Success' if success else 'Failed',
+        'response': response,
+        'message': message
+    } for _, members in recipients for name, phone in members]
+
+def format_result(result, index, total, timestamp, log_format):
+    """Render one send result as a progress report, or a JSON line for log_format 'jsonl'"""
+    if log_format == 'jsonl':
+        return json.dumps({
+            'ts': timestamp,
+            'name': result['name'],
+            'phone': result['phone'],
+            'ok': result['status'] == 'Success',
+            'response': result['response']
+        }) + "\n"
     
+    report = f"[{index}/{total}] {result['name']} ({result['phone']})\n"
+    if result['status'] == 'Success':
+        return report + "    ✅ SUCCESS\n\n"
+    return report + f"    ❌ FAILED: {result['response']}\n\n"
+
+def save_delivery_log(sheet, results):
+    """Append results to the Delivery_Log sheet, returning True once saved"""
     try:
-        response = requests.get(API_URL, params=params, timeout=15)
-        resp_text = response.text.strip()
-        
         try:
-            resp_json = response.json()
-            return resp_json.get("status") == "success", resp_text
-        except ValueError:
-            # If not JSON, check for 'OK'
-            return resp_text.upper().startswith("OK"), resp_text
+            log_sheet = sheet.worksheet("Delivery_Log")
+        except gspread.exceptions.WorksheetNotFound:
+            # Create log sheet if it doesn't exist
+            log_sheet = sheet.add_worksheet(title="Delivery_Log", rows="1000", cols="6")
+            log_sheet.append_row(['Timestamp', 'Name', 'Phone', 'Status', 'Response', 'Message'])
     except Exception as e:
-        return False, str(e)
+        print(f"⚠️ Could not save delivery log: {e}")
+        return False
+    
+    # Append all results to log in a single request
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    rows = [[
+        timestamp,
+        result['name'],
+        result['phone'],
+        result['status'],
+        result['response'],
+        result['message'][:50] + '...'
+    ] for result in results]
+    if not rows:
+        return True
+    
+    # Back off and retry when the Sheets write quota is exhausted
+    for attempt in range(LOG_WRITE_ATTEMPTS):
+        try:
+            log_sheet.append_rows(rows, value_input_option="RAW")
+            return True
+        except Exception as e:
+            # Anything but a quota error (including network failures) is final
+            quota_exceeded = (isinstance(e, gspread.exceptions.APIError) and
+                              e.response.status_code == 429)
+            if not quota_exceeded or attempt == LOG_WRITE_ATTEMPTS - 1:
+                print(f"⚠️ Could not save delivery log: {e}")
+                return False
+            time.sleep(2 ** attempt)
 
 def main():
+    config = load_config()
+    
+    # In jsonl mode stdout carries only the JSON lines; the banner,
+    # warnings and report go to stderr until the run is over
+    results_out = sys.stdout
+    report = sys.stderr if config.log_format == 'jsonl' else sys.stdout
+    with redirect_stdout(report):
+        run_campaign(config, results_out)
+
+def run_campaign(config, results_out):
+    """Send the campaign, writing one result line per member to results_out"""
     print("\n" + "="*60)
     print("✝️  CHURCH SMS AUTOMATION SYSTEM")
     print("="*60 + "\n")
     print(f"⏰ Execution Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
     
     # Validate API key
-    if not KUDI_API_KEY:
+    if not config.kudi_api_key:
         print("❌ ERROR: Missing KUDI_API_KEY\n")
         exit(1)
     
-    if not GOOGLE_SHEETS_CREDS:
+    if not config.google_sheets_creds:
         print("❌ ERROR: Missing GOOGLE_SHEETS_CREDS\n")
         exit(1)
     
-    if not SPREADSHEET_ID:
+    if not config.spreadsheet_id:
         print("❌ ERROR: Missing SPREADSHEET_ID\n")
         exit(1)
     
     # Connect to Google Sheets
-    sheet = connect_to_sheets()
+    sheet = connect_to_sheets(config)
     
     # Get settings and members
     settings = get_settings(sheet)
@@ -166,81 +273,84 @@ def main():
     message_template = settings.get('message_template', 
                                     'Hello {name}, this is a message from our church. God bless you!')
     
+    # Member columns, all indexed by row
+    count = max(map(len, members.values()), default=0)
+    names = members.get('name', ['Member'] * count)
+    phones = members.get('phone', [''] * count)
+    genders = members.get('gender', [''] * count)
+    addresses = members.get('address', [''] * count)
+    statuses = members.get('status', ['active'] * count)
+    
     # Filter active members with valid phone numbers
     valid_members = []
-    for member in members:
-        phone = str(member.get('phone', '')).strip()
-        status = str(member.get('status', 'active')).lower()
+    for i in range(count):
+        phone = phones[i].strip()
         
-        if phone and status == 'active':
-            valid_members.append(member)
+        if phone and statuses[i].lower() == 'active':
+            cleaned = clean_phone(phone)
+            if cleaned:
+                valid_members.append((i, cleaned))
+            else:
+                print(f"⚠️ Skipping {names[i]}: invalid phone number {phone}")
     
-    print(f"📱 Valid Active Members: {len(valid_members)}")
+    total = len(valid_members)
+    print(f"📱 Valid Active Members: {total}")
     print(f"📤 Sender ID: {sender_id}")
     print(f"🔗 API Endpoint: {API_URL}")
     print("="*60)
     print("🚀 Starting SMS campaign...\n")
     
-    # Send messages
+    # Send messages; the counts are SMS, which can be fewer than members
     success_count = 0
     failed_count = 0
     results = []
     
-    for i, member in enumerate(valid_members, 1):
-        name = member.get('name', 'Member')
-        phone = str(member.get('phone', '')).strip()  # Convert to string first
-        
-        # Personalize message
-        personalized_msg = personalize_message(message_template, member)
-        
-        print(f"[{i}/{len(valid_members)}] Sending to {name} ({phone})...")
-        
-        # Send SMS
-        success, response = send_sms(phone, personalized_msg, sender_id, gateway)
-        
-        if success:
-            print(f"    ✅ SUCCESS\n")
-            success_count += 1
-            results.append({
-                'name': name,
-                'phone': phone,
-                'status': 'Success',
-                'response': response
-            })
-        else:
-            print(f"    ❌ FAILED: {response}\n")
-            failed_count += 1
-            results.append({
-                'name': name,
-                'phone': phone,
-                'status': 'Failed',
-                'response': response
-            })
-        
-        # Rate limiting: wait 1 second between messages
-        if i < len(valid_members):
-            time.sleep(1)
+    # Members whose personalized text comes out identical share bulk
+    # requests of up to batch_size recipients. A number listed more than
+    # once for the same text is only sent to once, but every member
+    # sharing it still gets a result.
+    groups = defaultdict(dict)
+    for i, cleaned in valid_members:
+        message = personalize_message(message_template, names[i], genders[i], addresses[i])
+        groups[message].setdefault(cleaned, []).append((names[i], phones[i].strip()))
     
-    # Update delivery log in Google Sheets
-    try:
-        log_sheet = sheet.worksheet("Delivery_Log")
-    except:
-        # Create log sheet if it doesn't exist
-        log_sheet = sheet.add_worksheet(title="Delivery_Log", rows="1000", cols="6")
-        log_sheet.append_row(['Timestamp', 'Name', 'Phone', 'Status', 'Response', 'Message'])
+    sms_total = sum(map(len, groups.values()))
+    duplicates = total - sms_total
+    if duplicates:
+        print(f"📵 Skipping {duplicates} duplicate number(s)\n")
     
-    # Append results to log
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    for result in results:
-        log_sheet.append_row([
-            timestamp,
-            result['name'],
-            result['phone'],
-            result['status'],
-            result['response'],
-            personalize_message(message_template, 
-                              {'name': result['name']})[:50] + '...'
-        ])
+    batch_size = min(config.batch_size, MAX_RECIPIENTS_PER_REQUEST)
+    batches = []
+    for message, numbers in groups.items():
+        recipients = list(numbers.items())
+        batches.extend((recipients[i:i + batch_size], message)
+                       for i in range(0, len(recipients), batch_size))
+    
+    # Send concurrently, reporting each batch as soon as it completes
+    client = KudiClient(config.kudi_api_key, sender_id, gateway, pool_size=config.concurrency,
+                        requests_per_minute=config.requests_per_minute, retries=config.retries,
+                        retry_base=config.retry_base, retry_cap=config.retry_cap)
+    with client, ThreadPoolExecutor(max_workers=config.concurrency) as executor:
+        futures = {executor.submit(send_batch, client, recipients, message): len(recipients)
+                   for recipients, message in batches}
+        for future in as_completed(futures):
+            # One result per member, but one SMS per distinct number in the batch
+            batch_results = future.result()
+            if batch_results[0]['status'] == 'Success':
+                success_count += futures[future]
+            else:
+                failed_count += futures[future]
+            
+            # Write each batch's report in one go rather than a print per line
+            lines = []
+            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            for result in batch_results:
+                results.append(result)
+                lines.append(format_result(result, len(results), total, timestamp, config.log_format))
+            results_out.writelines(lines)
+    
+    # Update delivery log in Google Sheets
+    log_saved = save_delivery_log(sheet, results)
     
     # Final summary
     print("\n" + "="*60)
@@ -248,8 +358,10 @@ def main():
     print("="*60)
     print(f"✅ Successful: {success_count}")
     print(f"❌ Failed: {failed_count}")
-    print(f"📱 Total Sent: {len(valid_members)}")
-    print(f"💾 Log saved to Google Sheets")
+    print(f"📱 Total Sent: {sms_total}")
+    if duplicates:
+        print(f"👥 Members Covered: {total} ({duplicates} sharing a number)")
+    print("💾 Log saved to Google Sheets" if log_saved else "⚠️ Log NOT saved to Google Sheets")
     print("="*60 + "\n")
 
 if __name__ == "__main__":